@@ -1,22 +1,37 @@
-import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import uuid
+import zipfile
 import MeCab
-import epub_meta
-from utils import save_base64_image, convert_epub_to_txt, process_japanese_text, parse_sentence, remove_ruby_text_from_epub
-from frequency_lists import get_all_frequency_lists, get_frequency
+from utils import save_image, convert_epub_to_txt, get_epub_metadata, parse_sentence
+from frequency_lists import get_word_frequencies, get_frequency
 
 from Book import Book
 
 from pathlib import Path
+from types import MappingProxyType
 import hashlib
-import mmap
-import json
-import simplejson
-from constants import UPLOAD_FOLDER
-import numpy as np 
-import pandas as pd 
-import matplotlib.pyplot as plt
-import plotly.express as px
-import plotly.io as pio
+import orjson
+from constants import UPLOAD_FOLDER, HASH_CHUNK_SIZE, HISTOGRAM_BIN_WIDTH
+
+# Loaded on the first call to get_tagger and kept for the lifetime of the process
+_tagger = None
+# A MeCab Tagger can only parse one text at a time, so hold this while using the shared tagger
+_tagger_lock = threading.Lock()
+
+def get_tagger() -> MeCab.Tagger:
+    """
+    Returns the MeCab Tagger used for parsing. Creating a Tagger loads
+    the whole dictionary, so it is only created once per process.
+    """
+    global _tagger
+    with _tagger_lock:
+        if _tagger is None:
+            _tagger = MeCab.Tagger('-r /dev/null -d /usr/lib/mecab/dic/mecab-ipadic-neologd/')
+
+    return _tagger
 
 def sha256sum(filename: str) -> str:
     """
@@ -24,13 +39,25 @@ def sha256sum(filename: str) -> str:
     Arguments:
     filename: str - The path to the file to compute the hash of
     """
-    h  = hashlib.sha256()
     with open(filename, 'rb') as f:
-        with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
-            h.update(mm)
-    return h.hexdigest()
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        # hashlib.file_digest is only available on python 3.11+
+        h = hashlib.sha256()
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            h.update(chunk)
+        return h.hexdigest()
 
-def process_file(filename: str) -> Book:
+def get_book_dir(file_hash: str) -> str:
+    """
+    Returns the directory the generated files for the book
+    with the given hash are saved in.
+    Arguments:
+    file_hash: str - The sha256sum hash of the file
+    """
+    return f'static/books/{file_hash}'
+
+def process_file(filename: str, file_hash: str = None) -> Book:
     """
     Process the given ebook file and returns a Book
     object describing it. The Book object contains various
@@ -39,20 +66,19 @@ def process_file(filename: str) -> Book:
     that has been processed to allow for easy analysis
     Arguments:
     filename: str - The path to the file
+    file_hash: str (optional) - The sha256sum hash of the file,
+    if it has already been computed
     """
-    allowed_extensions = ['epub', 'txt']
-    extension = filename.split('.')[-1]
+    extension = Path(filename).suffix.lstrip('.')
+    if extension not in FILE_PROCESSORS:
+        raise ValueError(f'Filename extension must be one of {",".join(FILE_PROCESSORS)}')
 
-    file_hash = sha256sum(filename)
-    book_dir = f'static/books/{file_hash}'
-    subprocess.run(f'mkdir -p {book_dir}', shell=True)
+    if not file_hash:
+        file_hash = sha256sum(filename)
+    book_dir = get_book_dir(file_hash)
+    Path(book_dir).mkdir(parents=True, exist_ok=True)
 
-    if extension == 'epub':
-        return process_epub(filename, book_dir=book_dir, file_hash=file_hash)
-    elif extension == 'txt':
-        return process_txt(filename, book_dir=book_dir, file_hash=file_hash)
-    else:
-        raise ValueError(f'Filename extension must be one of {",".join(allowed_extensions)}')
+    return FILE_PROCESSORS[extension](filename, book_dir=book_dir, file_hash=file_hash)
 
 def process_epub(filename: str, book_dir: str, file_hash: str) -> Book:
     """
@@ -62,19 +88,19 @@ def process_epub(filename: str, book_dir: str, file_hash: str) -> Book:
     book_dir: str - The directory the book is in
     file_hash: str - The sha256sum hash of the file
     """
-    book_path = remove_ruby_text_from_epub(filename,
-                                            new_filename=f"{book_dir}/no-furigana.epub")
-    book_metadata = epub_meta.get_epub_metadata(book_path)
-    title = book_metadata['title']
-    authors = book_metadata['authors']
-    image = book_metadata['cover_image_content']
+    with zipfile.ZipFile(filename) as epub:
+        book_metadata = get_epub_metadata(epub)
 
-    image_path = save_base64_image(image, f'{book_dir}/cover-image.jpg')
-    txt_file = convert_epub_to_txt(book_path, process_text=True)
+        image_path = ''
+        if book_metadata.cover:
+            image_path = save_image(epub.read(book_metadata.cover), f'{book_dir}/cover-image.jpg')
+        txt_file = convert_epub_to_txt(epub, book_metadata.spine,
+                                       txt_filename=f'{book_dir}/book.txt',
+                                       process_text=True)
 
     book = Book(path=txt_file,
-            title=title,
-            authors=authors,
+            title=book_metadata.title,
+            authors=book_metadata.authors,
             image=image_path,
             file_hash=file_hash,
             book_dir=book_dir
@@ -89,8 +115,7 @@ def process_txt(filename: str, book_dir: str, file_hash: str) -> Book:
     book_dir: str - The directory the book is in
     file_hash: str - The sha256sum hash of the file
     """
-    extension = '.' + filename.split('.')[-1]
-    title = filename.split('/')[-1].replace(extension, '')
+    title = Path(filename).stem
     book = Book(path=filename,
             title=title,
             authors=[],
@@ -100,38 +125,61 @@ def process_txt(filename: str, book_dir: str, file_hash: str) -> Book:
             )
     return book
 
+# functions that turn a file into a Book, by file extension
+FILE_PROCESSORS = {
+    'epub': process_epub,
+    'txt': process_txt,
+}
+
 def analyse_ebook(filename: str) -> object:
     """
     Analayse a ebook containing japanese text, determining various things
     like the length of the book in words/characters, the number of unique
     words and characters used, and the number of words and characters that
     are used once only. Returns and object containing this information.
+    The results are saved by the file's sha256sum hash, so if the same
+    file has been analysed before, the saved results are returned
+    straight away. Either way the result is the parsed json, so the
+    frequencies of each word are plain dictionaries.
     Arguments:
     filename: str - The path to the file to analyse
     """
 
-    mt = MeCab.Tagger('-r /dev/null -d /usr/lib/mecab/dic/mecab-ipadic-neologd/')
-    book = process_file(filename)
-    frequency_lists = get_all_frequency_lists()
+    file_hash = sha256sum(filename)
+    json_filename = f'{get_book_dir(file_hash)}/book_data.json'
+    if Path(json_filename).is_file():
+        with open(json_filename, 'rb') as file:
+            book_data = orjson.loads(file.read())
+        print(f'{filename} has already been analysed, read data from {json_filename}')
+        clean_dir(UPLOAD_FOLDER)
+        return book_data
+
+    book = process_file(filename, file_hash=file_hash)
 
     with open(book.path, 'r', encoding='utf-8') as file:
         text = file.read()
 
+    # counting characters and words are independent, so they are run side by side,
+    # together with loading the frequency lists
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        char_counts_future = executor.submit(Counter, text)
+        word_counts_future = executor.submit(count_words, text)
+        word_frequencies_future = executor.submit(get_word_frequencies)
+        char_counts = char_counts_future.result()
+        word_counts = word_counts_future.result()
+        word_frequencies_future.result()
+
     # Analysing characters
-    chars = list(text)
-    unique_chars = set(text)
-    chars_with_uses = sorted([(char, chars.count(char)) for char in unique_chars], key=lambda tup: tup[1], reverse=True)
-    chars_used_once = [char for char, count in chars_with_uses if count == 1]
+    chars_with_uses = char_counts.most_common()
+    chars_used_once = [char for char, count in char_counts.items() if count == 1]
 
     # analysing words
-    words = parse_sentence(text, mt)
-    unique_words = set(words)
-    words_with_uses = sorted([(word, words.count(word)) for word in unique_words], key=lambda tup: tup[1], reverse=True)
-    used_once = [word for word, uses in words_with_uses if uses == 1]
+    words_with_uses = word_counts.most_common()
+    used_once = [word for word, uses in word_counts.items() if uses == 1]
 
     word_list = [{"word": word,
                   "ocurrences": occurences,
-                  "frequency": get_frequency(word, frequency_lists)
+                  "frequency": get_frequency(word)
                   }
                   for word, occurences in words_with_uses
                   ]
@@ -141,28 +189,62 @@ def analyse_ebook(filename: str) -> object:
         'title': book.title,
         'authors': book.authors,
         'image': book.image,
-        'n_words': len(words),
-        'n_words_unique': len(unique_words),
+        'n_words': sum(word_counts.values()),
+        'n_words_unique': len(word_counts),
         'n_words_used_once': len(used_once),
-        'n_chars': len(chars),
-        'n_chars_unique': len(unique_chars),
+        'n_chars': len(text),
+        'n_chars_unique': len(char_counts),
         'n_chars_used_once': len(chars_used_once),
         'words': word_list,
         'chars': char_list,
         'file_hash': book.file_hash
     }
 
-    json_filename = f'{book.book_dir}/book_data.json'
-    with open(json_filename, 'w', encoding='utf-8') as file:
-            simplejson.dump(book_data, file)
-            #json.dump(book_data, file)
+    json_data = orjson.dumps(book_data, default=json_default)
+    # write to a temporary file first, an existing book_data.json is taken as a finished analysis.
+    # it ends in .json so clean_dir doesn't delete it if the same file is being analysed at once
+    temp_filename = f'{book.book_dir}/book_data.{uuid.uuid4().hex}.tmp.json'
+    try:
+        with open(temp_filename, 'xb') as file:
+            file.write(json_data)
+        os.replace(temp_filename, json_filename)
+    except BaseException:
+        Path(temp_filename).unlink(missing_ok=True)
+        raise
     print(f'wrote data to {json_filename}')
 
     clean_dir(book.book_dir, keep_extensions=['.json', '.jpg', '.png'])
     clean_dir(UPLOAD_FOLDER)
     gethistogram(word_list) 
 
-    return book_data
+    # return the same shape as a book that was read back from book_data.json
+    return orjson.loads(json_data)
+
+def count_words(text: str) -> Counter:
+    """
+    Parses the given text into words using the shared MeCab tagger
+    and returns a Counter with the number of uses of each word.
+    Arguments:
+    text: str - The text to parse
+    """
+    mt = get_tagger()
+    with _tagger_lock:
+        return Counter(parse_sentence(text, mt))
+
+def json_default(obj: object) -> dict:
+    """
+    Default function for orjson.dumps. Serializes NamedTuples, like the
+    frequency_lists.Word objects in the word list, as json objects
+    instead of arrays, and read-only mappings like
+    frequency_lists.NO_FREQUENCY as json objects.
+    Arguments:
+    obj: object - The object orjson could not serialize
+    """
+    if isinstance(obj, tuple) and hasattr(obj, '_asdict'):
+        return obj._asdict()
+    if isinstance(obj, MappingProxyType):
+        return dict(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
 
 def clean_dir(directory: str, keep_extensions: list = None) -> None:
     """
@@ -184,55 +266,26 @@ def clean_dir(directory: str, keep_extensions: list = None) -> None:
 
 def gethistogram(word_list):
     """
-    This functions Creates a pandas dataframe of Range and stars of the data in word_list that has 'netflix' in it.
+    This functions Creates a pandas dataframe of Range and the number of Words of the data in word_list
+    that has 'netflix' in it, and plots it as a histogram.
     Range is the bins of the histogram
     """
-    bins =  generatebins(getmaximumfreq(word_list)) #generating the bins
-    dic = {"Range": "0-500" ,"Stars": [np.nan]} #Creating the columns of the data framw
-    df = pd.DataFrame(dic)
-    for i in bins:
-        df = df.append({'Range':i,'Stars':0},ignore_index=True) 
-    for i in word_list:
-        key = 'netflix' #netflix is the key
-        if key in i['frequency'].keys():  # element is: i['frequency']['netflix'].frequency
-            df = df.append({"Range":bins[getbins(i['frequency']['netflix'].frequency,bins)],"Stars":i['frequency']['netflix'].stars},ignore_index=True)
+    # these take a long time to import and are only needed here
+    import numpy as np
+    import pandas as pd
+    import plotly.express as px
+    import plotly.io as pio
+
+    key = 'netflix' #netflix is the key
+    freqs = np.array([i['frequency'][key].frequency for i in word_list if key in i['frequency']],
+                     dtype=np.int64)
+    # bin index of every word, computed in place. bincount sizes the result to fit the highest index,
+    # so there is no separate pass to find the maximum frequency
+    bin_indices = np.floor_divide(freqs, HISTOGRAM_BIN_WIDTH, out=freqs)
+    counts = np.bincount(bin_indices, minlength=1) # number of words in each bin
+    n_bins = len(counts)
+    labels = [f'{a}-{a + HISTOGRAM_BIN_WIDTH}' for a in range(0, n_bins * HISTOGRAM_BIN_WIDTH, HISTOGRAM_BIN_WIDTH)]
+    df = pd.DataFrame({"Range": labels, "Words": counts}) # building the data frame in one go
     stars_design = ["★","★★","★★★","★★★★","★★★★★"]
-    fig = px.histogram(df, 'Range',color='Range') # generating the plotly histogram
+    fig = px.bar(df, x='Range', y='Words', color='Range') # generating the plotly histogram
     pio.write_html(fig, file='Histogram.html')
-
-def getbins(freq_num,bins):
-    """
-    This function determines which range the number falls into
-    example: 100, will fall into the range '0-500' 
-    """
-    flag=1
-    for i in range(len(bins)):
-        lst = bins[i].split("-")
-        if freq_num >= int(lst[0]) and freq_num < int(lst[1]):
-            return i 
-    return (len(bins)-1)
-        
-
-def generatebins(maximum_num):
-    """
-    This function generates bins based on the maximum element value 
-    """
-    a = 0
-    b= 500
-    lst=[]
-    while(b<=maximum_num):
-        lst.append(str(a)+"-"+str(b))
-        a=b
-        b=b+500
-    return lst
-
-def getmaximumfreq(word_list):
-    """
-    This functions gets the highest frequency value of the word
-    """
-    maximum_num = 0
-    for i in word_list:
-        key = 'netflix'
-        if key in i['frequency'].keys():
-            maximum_num = max(maximum_num,i['frequency']['netflix'].frequency)
-    return maximum_num
\ No newline at end of file
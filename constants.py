@@ -1,2 +1,6 @@
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'txt', 'epub'}
+HASH_CHUNK_SIZE = 1 << 20
+HISTOGRAM_BIN_WIDTH = 500
+FREQUENCY_LIST_DIR = 'frequency-lists'
+FREQUENCY_LIST_CACHE = 'frequency-lists/word_frequencies.pickle'
@@ -1,9 +1,16 @@
 from dataclasses import dataclass
-from typing import List, Dict, Union, NamedTuple
+from typing import List, Dict, Mapping, Union, NamedTuple
 from pathlib import Path
+from types import MappingProxyType
 
 import re
 import json
+import os
+import pickle
+import threading
+import uuid
+
+from constants import FREQUENCY_LIST_DIR, FREQUENCY_LIST_CACHE
 
 class Word(NamedTuple):
     frequency: int
@@ -45,12 +52,22 @@ def stars_from_frequency(freq: int) -> int:
         a positive integer as the frequency.
         ''')
 
+# Frequencies of a word that isn't in any of the frequency lists. It is
+# shared by all of those words, so it is read-only
+NO_FREQUENCY = MappingProxyType({'Overall': 'N/A'})
+
+# Loaded on the first call to get_word_frequencies and kept for the
+# lifetime of the process
+_word_frequencies = None
+# Held while loading, so concurrent first requests don't each build the dictionary
+_word_frequencies_lock = threading.Lock()
+
 def get_all_frequency_lists() -> List[FrequencyList]:
     """
     Gets a list of FrequencyList objects for each of the
     frequency list json files in the frequency list directory
     """
-    p = Path('frequency-lists').glob('*.json')
+    p = sorted(Path(FREQUENCY_LIST_DIR).glob('*.json'))
     frequency_lists = []
     for path in p:
         frequency_list = process_frequency_list(str(path))
@@ -58,6 +75,76 @@ def get_all_frequency_lists() -> List[FrequencyList]:
 
     return frequency_lists
 
+def get_word_frequencies() -> Dict[str, Dict[str, Word]]:
+    """
+    Returns a dictionary mapping every word in any of the frequency lists
+    to its frequencies, in the same format as get_frequency.
+    The dictionary is only loaded once per process, see load_word_frequencies.
+    It is shared, so it must not be modified.
+    """
+    global _word_frequencies
+    if _word_frequencies is not None:
+        return _word_frequencies
+    with _word_frequencies_lock:
+        if _word_frequencies is None:
+            _word_frequencies = load_word_frequencies()
+
+    return _word_frequencies
+
+def build_word_frequencies(frequency_lists: List[FrequencyList]) -> Dict[str, Dict[str, Word]]:
+    """
+    Combines the given frequency lists into a single dictionary mapping
+    each word to its frequency in each of the lists it is in, as well as
+    its overall frequency.
+    Arguments:
+    frequency_lists: List[FrequencyList] - The frequency lists to combine
+    """
+    word_frequencies = {}
+    for frequency_list in frequency_lists:
+        for word, frequency in frequency_list.words.items():
+            word_frequencies.setdefault(word, {})[frequency_list.name] = frequency
+
+    for frequencies in word_frequencies.values():
+        frequencies['Overall'] = get_overall_frequency(frequencies)
+
+    return word_frequencies
+
+def load_word_frequencies() -> Dict[str, Dict[str, Word]]:
+    """
+    Loads the combined word frequencies from the pickled cache at
+    FREQUENCY_LIST_CACHE, so the json files don't have to be parsed again.
+    If the cache is missing or any of the json files have changed since it
+    was written, the json files are processed and the cache is rewritten.
+    """
+    paths = sorted(Path(FREQUENCY_LIST_DIR).glob('*.json'))
+    sources = [(path.name, path.stat().st_mtime_ns, path.stat().st_size) for path in paths]
+
+    cache = Path(FREQUENCY_LIST_CACHE)
+    if cache.is_file():
+        try:
+            with open(cache, 'rb') as file:
+                cached_sources, word_frequencies = pickle.load(file)
+            if cached_sources == sources:
+                return word_frequencies
+        except Exception:
+            # unreadable or written in an older format, so it is rebuilt
+            pass
+
+    word_frequencies = build_word_frequencies(get_all_frequency_lists())
+
+    # write to a temporary file first so other processes never read a partial cache.
+    # open() creates it with the usual umask permissions, so other users can read the cache
+    temp_cache = cache.with_name(f'{cache.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(temp_cache, 'xb') as file:
+            pickle.dump((sources, word_frequencies), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_cache, cache)
+    except BaseException:
+        temp_cache.unlink(missing_ok=True)
+        raise
+
+    return word_frequencies
+
 def get_overall_frequency(frequencies: Dict[str, Word]) -> Union[Word, str]:
     """
     Given the frequency of a word from several different frequency lists,
@@ -75,25 +162,15 @@ def get_overall_frequency(frequencies: Dict[str, Word]) -> Union[Word, str]:
     return Word(overall_frequency, stars_from_frequency(overall_frequency))
 
 
-def get_frequency(word: str, frequency_lists: List[FrequencyList]) -> Dict[str, Word]:
+def get_frequency(word: str) -> Mapping[str, Word]:
     """
     Returns the frequency of the word for each frequency list
-    specified.
+    it is in, as well as its overall frequency. The returned
+    dictionary is shared, so it must not be modified.
     Arguments:
     word: str - The word to get the frequency of
-    frequency: List[FrequencyList] - The list of frequency lists to use
     """
-    frequencies = {}
-    for frequency_list in frequency_lists:
-        try:
-            frequency = frequency_list.words[word]
-            frequencies[frequency_list.name] = frequency
-        except KeyError:
-            continue
-
-    frequencies['Overall'] = get_overall_frequency(frequencies)
-
-    return frequencies
+    return get_word_frequencies().get(word, NO_FREQUENCY)
 
 def process_frequency_list(filename: str) -> FrequencyList:
     """
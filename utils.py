@@ -1,11 +1,41 @@
-import base64
-import subprocess
 import re
 import json
+import posixpath
+import zipfile
 from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional
+from urllib.parse import unquote
+
+from lxml import etree
 
 from frequency_lists import FrequencyList
 
+EPUB_NAMESPACES = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+}
+
+# parser for the xml files in an epub, which are user uploads, so entities are not expanded
+# and nothing is fetched over the network
+EPUB_XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+
+# ruby text (furigana) and non-content elements that should not end up in the text
+IGNORED_TAGS = {'rt', 'rp', 'head', 'script', 'style'}
+
+# everything except japanese characters and punctuation. \u3000 (ideographic space)
+# is left out of the japanese ranges so it gets removed as well
+NON_JAPANESE_REGEX = re.compile(r"[^\u3001-\u303F\u3040-\u309F\u30A0-\u30FF\uFF00-\uFFEF\u4E00-\u9FAF\u2605-\u2606\u2190-\u2195\u203B]+")
+
+# whitespace and the characters that are stripped from every word by parse_sentence
+WORD_FILTER_REGEX = re.compile(r'\s|[' + re.escape(r'()./,!:?\uksa0123456789\t\r\s .') + ']')
+
+class EpubMetadata(NamedTuple):
+    title: str
+    authors: List[str]
+    cover: Optional[str]
+    spine: List[str]
+
 def get_all_subdirs(path: str) -> list:
     """
     Returns a list of all the subdirectories that exist
@@ -25,7 +55,7 @@ def get_books() -> list:
     books = []
     for book_dir in book_dirs:
         filename = f'{book_dir}/book_data.json'
-        with open(filename) as file:
+        with open(filename, encoding='utf-8') as file:
             book_data = json.load(file)
         books.append(book_data)
     return books
@@ -37,67 +67,144 @@ def get_book(hash: str) -> object:
     hash: str - The sha256 sum hash for the epub file
     """
 
-    with open(f'static/books/{hash}/book_data.json') as file:
+    with open(f'static/books/{hash}/book_data.json', encoding='utf-8') as file:
         book_data = json.load(file)
         return book_data
 
-def save_base64_image(base64string: str, filename: str) -> str:
+def save_image(image_data: bytes, filename: str) -> str:
     """
-    Decodes the given base64 string and saves it as an image with the specified
+    Saves the given image data as an image with the specified
     filename. Returns the filename.
     Arguments:
-    base64string: str - The base64 string encoded string
+    image_data: bytes - The raw image data
     filename: str - The filename you want to save the image to
     """
-    image_data = base64.b64decode(base64string)
     with open(filename, 'wb') as file:
         file.write(image_data)
     return filename
 
-def remove_ruby_text_from_epub(
-        filename:  str,
-        new_filename: str = None
-        ) -> str:
+def resolve_epub_href(opf_dir: str, href: str) -> str:
     """
-    Removes all ruby text from the given .epub file.
-    Requires furigana4epub to be installed and in system path
-    Returns the path of the new file
-    (pip install furigana4epub).
+    Returns the path inside the epub archive that the given
+    manifest href points to.
     Arguments:
-    filename: str - The filename for the epub file to remove ruby text
-    from
+    opf_dir: str - The directory of the package document (.opf) in the archive
+    href: str - The (url encoded) href, relative to the package document
     """
-    if not new_filename:
-        new_filename = filename
+    return posixpath.normpath(posixpath.join(opf_dir, unquote(href)))
 
-    name = filename.replace('.epub', '')
-    subprocess.run(f'furigana4epub -d {filename}', shell=True)
-    subprocess.run(f'mv {name}_no_furigana.epub {new_filename}', shell=True)
-    return new_filename
+def get_epub_metadata(epub: zipfile.ZipFile) -> EpubMetadata:
+    """
+    Reads the title, authors, cover image and reading order
+    of the given epub from its package document (.opf).
+    Returns an EpubMetadata object.
+    Arguments:
+    epub: zipfile.ZipFile - The opened epub file
+    """
+    container = etree.fromstring(epub.read('META-INF/container.xml'), EPUB_XML_PARSER)
+    opf_path = container.find('.//container:rootfile', EPUB_NAMESPACES).get('full-path')
+    opf_dir = posixpath.dirname(opf_path)
+    opf = etree.fromstring(epub.read(opf_path), EPUB_XML_PARSER)
+
+    title = opf.findtext('.//dc:title', default='', namespaces=EPUB_NAMESPACES).strip()
+    authors = [creator.text.strip()
+               for creator in opf.iterfind('.//dc:creator', EPUB_NAMESPACES)
+               if creator.text]
+
+    manifest = {item.get('id'): item
+                for item in opf.iterfind('opf:manifest/opf:item', EPUB_NAMESPACES)}
+
+    # epub3 marks the cover in the manifest, epub2 uses <meta name="cover">
+    cover_item = next((item for item in manifest.values()
+                       if 'cover-image' in item.get('properties', '').split()),
+                      None)
+    if cover_item is None:
+        cover_meta = opf.find('.//opf:meta[@name="cover"]', EPUB_NAMESPACES)
+        if cover_meta is not None:
+            cover_item = manifest.get(cover_meta.get('content'))
+    cover = resolve_epub_href(opf_dir, cover_item.get('href')) if cover_item is not None else None
 
-def convert_epub_to_txt(filename: str,
+    spine = [resolve_epub_href(opf_dir, manifest[itemref.get('idref')].get('href'))
+             for itemref in opf.iterfind('opf:spine/opf:itemref', EPUB_NAMESPACES)
+             if itemref.get('idref') in manifest]
+
+    return EpubMetadata(title=title, authors=authors, cover=cover, spine=spine)
+
+class XhtmlTextTarget:
+    """
+    lxml parser target that collects the text of an xhtml document,
+    leaving out ruby text (furigana) and anything else in IGNORED_TAGS.
+    The parser returns the collected text when it is done.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.ignored_depth = 0
+
+    def start(self, tag, attrib):
+        if self.ignored_depth or tag.rpartition('}')[2] in IGNORED_TAGS:
+            self.ignored_depth += 1
+
+    def end(self, tag):
+        if self.ignored_depth:
+            self.ignored_depth -= 1
+
+    def data(self, data):
+        if not self.ignored_depth:
+            self.chunks.append(data)
+
+    def close(self):
+        return ''.join(self.chunks)
+
+def get_xhtml_text(xhtml: bytes) -> str:
+    """
+    Returns the text of the given xhtml document with all
+    ruby text removed.
+    Arguments:
+    xhtml: bytes - The contents of the xhtml document
+    """
+    parser = etree.XMLParser(target=XhtmlTextTarget(),
+                             recover=True,
+                             resolve_entities=False,
+                             no_network=True)
+    return etree.fromstring(xhtml, parser)
+
+def iter_epub_text(epub: zipfile.ZipFile, spine: List[str]) -> Iterator[str]:
+    """
+    Yields the text of each of the given content documents of the epub,
+    with all ruby text removed. The documents are read straight from
+    the epub archive one at a time.
+    Arguments:
+    epub: zipfile.ZipFile - The opened epub file
+    spine: List[str] - The paths of the content documents in reading order.
+    See get_epub_metadata
+    """
+    for path in spine:
+        yield get_xhtml_text(epub.read(path))
+
+def convert_epub_to_txt(epub: zipfile.ZipFile,
+                        spine: List[str],
+                        txt_filename: str,
                         process_text: bool = False
                         ) -> str:
     """
-    NOTE: requires pandoc to be in system path.
-    Converts the given epub file to a .txt file with
-    the same filename (minus extension) in the same directory.
+    Writes the text of the given epub, with all ruby text removed,
+    to a .txt file. The text of each content document is written
+    as soon as it has been parsed, so the epub is only unzipped and
+    parsed once and the text of the whole book is never joined in memory.
     Returns the filename of the .txt file
     Arguments:
-    filename : str - The filename of the .epub file you want to convert
+    epub: zipfile.ZipFile - The opened epub file
+    spine: List[str] - The paths of the content documents in reading order.
+    See get_epub_metadata
+    txt_filename: str - The filename of the .txt file to write to
     process_text: bool (optional, default = False) - Process
     the text to filter out any non-japanese text using a regex
     """
-
-    txt_filename = filename.replace('.epub', '.txt')
-    subprocess.run(f'./convert_epub_to_txt {filename}', shell=True)
-
-
-    if process_text:
-        with open(txt_filename, 'r', encoding='utf-8') as file:
-            text = file.read()
-        with open(txt_filename, 'w', encoding='utf-8') as file:
-            file.write(process_japanese_text(text))
+    with open(txt_filename, 'w', encoding='utf-8') as file:
+        for text in iter_epub_text(epub, spine):
+            if process_text:
+                text = process_japanese_text(text)
+            file.write(text)
 
     return txt_filename
 
@@ -108,25 +215,22 @@ def process_japanese_text(text: str) -> str:
     Arguments:
     text: str - The text to process
     """
-    regex = r"[\u3000-\u303F]|[\u3040-\u309F]|[\u30A0-\u30FF]|[\uFF00-\uFFEF]|[\u4E00-\u9FAF]|[\u2605-\u2606]|[\u2190-\u2195]|\u203B"
-    processed = ''.join(re.findall(regex, text)).replace('\u3000', '')
-    return processed
+    return NON_JAPANESE_REGEX.sub('', text)
 
 def parse_sentence(sentence: str, mt) -> list:
     """
     Parses the given sentence into a list of words using mecab.
+    The whole sentence is given to mecab in one go, so this can be
+    used on the full text of a book.
     Arguments:
     sentence: str - The sentence you want to parse
     mt - A mecab tagger. Create using MeCab.Tagger
     """
-    filter_str = r'()./,!:?\uksa0123456789\t\r\s .'
     parsed = mt.parseToNode(sentence)
     words = []
     while parsed:
-        word = re.sub(r'\s+', '', parsed.surface)
-        for char in filter_str:
-            word = word.replace(char, '')
-        if len(word) >= 1:
+        word = WORD_FILTER_REGEX.sub('', parsed.surface)
+        if word:
             words.append(word)
         parsed = parsed.next
     return words